@@ -1,15 +1,20 @@
+import io
 import os
-import json
 import time
+import orjson
+import asyncio
 import random
 import logging
 import re
+import hashlib
+from collections import OrderedDict, deque
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
 from instagrapi import Client
-import google.generativeai as genai
-from PIL import Image
+
+# PIL and google.generativeai are imported lazily where used: they cost
+# hundreds of ms and tens of MB, and images may never arrive at all
 
 # ==========================================
 # 🔧 LOAD SECRETS FROM .env FILE
@@ -34,9 +39,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger("EmperorBot")
 
+# --- COMPILED PATTERNS ---
+# Question forms that mean someone is asking Emperor something
+_EMPEROR_QUESTION_ALT = r'emperor.*\?|ai.*\?|bot.*\?|\?.*emperor'
+
+# Message item types that carry an image
+_IMAGE_ITEMS = frozenset({'media_share', 'visual_media'})
+
+# Words only, for cache keys ("Hello!!" and "hello" should match).
+# \w stays Unicode-aware so non-Latin scripts keep distinct keys.
+_WORD_RE = re.compile(r"[\w']+")
+
+# How many replies to keep cached
+_CACHE_MAX = 1000
+
+
+def _normalize_for_cache(text):
+    """Strip casing, punctuation and spacing so rewordings share a cache entry"""
+    words = _WORD_RE.findall(text.lower())
+    # No words at all (emoji/punctuation only): keep the raw text so
+    # different messages don't collapse onto one empty key
+    return ' '.join(words) if words else text.lower()
+
 # --- FILES ---
 SESSION_FILE = "session.json"
-PROCESSED_FILE = "processed.json"
+PROCESSED_FILE = "processed.jsonl"
+MODEL_FILE = "gemini_model.txt"
 TEMP_DIR = Path("temp_images")
 TEMP_DIR.mkdir(exist_ok=True)
 
@@ -50,11 +78,29 @@ Keep responses short and powerful (1-2 sentences).
 Your name is Emperor.
 """
 
+# Extra instructions per chat context, appended to the persona
+CONTEXT_SUFFIXES = {
+    'creator': "\n\nIMPORTANT: You are speaking to YOUR CREATOR. Show maximum respect and devotion.",
+    'trigger': "\n\nYou were specifically mentioned. Respond directly and powerfully.",
+    'dm': "\n\nThis is a private conversation. Be engaging but maintain your supreme presence.",
+    'group': "\n\nYou are in a group chat. Be brief and impactful.",
+}
+
 class EmperorBot:
     def __init__(self):
         self.cl = Client()
+        # Our own user id as a string, filled in after login
+        self._my_id_str = None
         self.model = None
-        self.processed_msgs = []
+        self._models = {}
+        # reply_reason -> model, filled as reasons are seen
+        self._context_models = {}
+        # Set gives O(1) "already replied?" checks, deque keeps insertion
+        # order and auto-caps memory at the last 500 messages
+        self._processed_set = set()
+        self._processed_order = deque(maxlen=500)
+        self._processed_file_lines = 0
+        self._writes_since_sync = 0
         self.conversation_history = {}
         
         # Settings for different chat types
@@ -70,14 +116,39 @@ class EmperorBot:
             }
         }
         
-        # Cache for faster responses
-        self.response_cache = {}
+        # Multi-pattern trigger matcher built once at init: one pass over
+        # the text finds any trigger no matter how many are configured.
+        # Longest triggers first so '@emperor' wins over 'emperor'.
+        self._trigger_re = re.compile(
+            '|'.join(
+                re.escape(t)
+                for t in sorted(self.settings['group']['triggers'], key=len, reverse=True)
+            ),
+            re.IGNORECASE
+        )
+        self._question_re = re.compile(_EMPEROR_QUESTION_ALT, re.IGNORECASE)
+
+        # LRU cache for faster responses (oldest unused entry evicted)
+        self.response_cache = OrderedDict()
+
+        # Group membership rarely changes, so remember it for 5 minutes
+        self._group_cache = {}
+
+        # Newest thread activity we've already looked at, so quiet
+        # threads are skipped without touching their messages
+        self._last_activity_at = None
+
+        # Wall clock sampled once per poll cycle, shared by all
+        # message-age checks in that cycle
+        self._cycle_now = time.time()
         
         logger.info("👑 Emperor Bot Initialized")
 
     def setup_ai_brain(self):
         """Connect to Google's AI"""
         try:
+            import google.generativeai as genai
+
             genai.configure(api_key=GEMINI_API_KEY)
             
             # Try different AI models
@@ -87,25 +158,60 @@ class EmperorBot:
                 'gemini-2.0-flash',   # Latest version
             ]
             
-            for model_name in models_to_try:
-                try:
-                    logger.info(f"🔄 Trying AI model: {model_name}")
-                    test_model = genai.GenerativeModel(model_name)
-                    # Quick test
-                    test_model.generate_content("Hello")
-                    self.model = test_model
-                    logger.info(f"✅ Connected to AI: {model_name}")
-                    return True
-                except:
-                    continue
-            
-            logger.error("❌ Could not connect to any AI model")
-            return False
-                
+            model_name = self._pick_model_name(genai, models_to_try)
+            if not model_name:
+                logger.error("❌ Could not connect to any AI model")
+                return False
+
+            self.model = genai.GenerativeModel(model_name)
+            # One model per chat context with the persona baked in
+            # as the system instruction. The stable prefix lets
+            # Gemini cache it instead of re-reading it every call.
+            self._models = {
+                ctx: genai.GenerativeModel(
+                    model_name,
+                    system_instruction=EMPEROR_PERSONA + suffix
+                )
+                for ctx, suffix in CONTEXT_SUFFIXES.items()
+            }
+            self._models['default'] = genai.GenerativeModel(
+                model_name, system_instruction=EMPEROR_PERSONA
+            )
+            self._context_models = {}
+            logger.info(f"✅ Connected to AI: {model_name}")
+            return True
+
         except Exception as e:
             logger.error(f"❌ AI Setup Error: {e}")
             return False
 
+    def _pick_model_name(self, genai, models_to_try):
+        """Pick the first preferred model Gemini actually offers"""
+        # A previous run already picked one — no API call needed at all
+        if os.path.exists(MODEL_FILE):
+            try:
+                cached = Path(MODEL_FILE).read_text().strip()
+                if cached:
+                    logger.info(f"📦 Using cached AI model: {cached}")
+                    return cached
+            except:
+                pass
+
+        # One list call instead of a billed test generation per candidate
+        available = {
+            m.name.removeprefix('models/')
+            for m in genai.list_models()
+            if 'generateContent' in m.supported_generation_methods
+        }
+        for model_name in models_to_try:
+            if model_name in available:
+                try:
+                    Path(MODEL_FILE).write_text(model_name)
+                except:
+                    pass
+                return model_name
+        return None
+
     def login_to_instagram(self):
         """Login to Instagram account"""
         logger.info("🔐 Logging into Instagram...")
@@ -115,6 +221,7 @@ class EmperorBot:
             try:
                 self.cl.load_settings(SESSION_FILE)
                 self.cl.login(IG_USER, IG_PASS)
+                self._my_id_str = str(self.cl.user_id)
                 logger.info("✅ Logged in with saved session")
                 return True
             except:
@@ -124,8 +231,9 @@ class EmperorBot:
         try:
             self.cl.login(IG_USER, IG_PASS)
             self.cl.dump_settings(SESSION_FILE)
+            self._my_id_str = str(self.cl.user_id)
             logger.info("✅ Login successful! Session saved.")
-            
+
             # Get your user ID and save it
             my_id = self.cl.user_id
             logger.info(f"📝 Your User ID: {my_id}")
@@ -140,120 +248,167 @@ class EmperorBot:
         """Load already replied messages"""
         if os.path.exists(PROCESSED_FILE):
             try:
-                with open(PROCESSED_FILE, 'r') as f:
-                    data = json.load(f)
-                    self.processed_msgs = data.get('processed', [])
-                logger.info(f"📚 Loaded {len(self.processed_msgs)} processed messages")
+                with open(PROCESSED_FILE, 'rb') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            self._mark_processed(orjson.loads(line))
+                            self._processed_file_lines += 1
+                logger.info(f"📚 Loaded {len(self._processed_set)} processed messages")
             except:
-                self.processed_msgs = []
+                self._processed_set = set()
+                self._processed_order = deque(maxlen=500)
 
-    def save_processed_messages(self):
-        """Save replied messages"""
-        # Keep only last 500 messages to avoid file getting too big
-        if len(self.processed_msgs) > 500:
-            self.processed_msgs = self.processed_msgs[-500:]
-        
+    def _mark_processed(self, message_id):
+        """Remember a replied message (oldest entry falls out at 500)"""
+        if message_id in self._processed_set:
+            return
+        if len(self._processed_order) == self._processed_order.maxlen:
+            self._processed_set.discard(self._processed_order[0])
+        self._processed_order.append(message_id)
+        self._processed_set.add(message_id)
+
+    def save_processed_messages(self, message_id):
+        """Append one replied message id to the log"""
+        # Append-only log: no need to rewrite the whole history per reply
+        try:
+            with open(PROCESSED_FILE, 'ab') as f:
+                f.write(orjson.dumps(message_id) + b"\n")
+                # fsync is expensive, so only force it every 25 writes
+                self._writes_since_sync += 1
+                if self._writes_since_sync >= 25:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._writes_since_sync = 0
+            self._processed_file_lines += 1
+        except:
+            pass
+
+    def compact_processed_file(self):
+        """Rewrite the log once it holds twice the 500 ids we keep"""
+        if self._processed_file_lines <= 1000:
+            return
+        # Write to a temp file and swap it in atomically: a crash
+        # mid-rewrite can't truncate the ledger, which would make the
+        # bot re-reply (and re-pay Gemini) for old messages on restart
+        tmp = PROCESSED_FILE + '.tmp'
         try:
-            with open(PROCESSED_FILE, 'w') as f:
-                json.dump({'processed': self.processed_msgs}, f, indent=2)
+            with open(tmp, 'wb') as f:
+                for message_id in self._processed_order:
+                    f.write(orjson.dumps(message_id) + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, PROCESSED_FILE)
+            self._processed_file_lines = len(self._processed_order)
         except:
             pass
 
     def is_group_chat(self, thread):
         """Check if it's a group chat (more than 2 people)"""
+        thread_id = str(thread.id)
+        now = time.time()
+        cached = self._group_cache.get(thread_id)
+        if cached and now - cached[0] < 300:
+            return cached[1]
+
         try:
             # If thread has users and more than 2 total (including you)
             if hasattr(thread, 'users') and thread.users:
-                return len(thread.users) > 2
-            return False
+                is_group = len(thread.users) > 2
+            else:
+                is_group = False
         except:
-            return False
+            is_group = False
+
+        self._group_cache[thread_id] = (now, is_group)
+        return is_group
 
     def should_reply_to_message(self, message, thread):
         """Decide if Emperor should reply"""
         message_id = str(message.id)
         
+        # Cheapest rejections first: most polled messages are already
+        # seen or our own, so bail before any regex or thread work
+
         # Skip if already replied
-        if message_id in self.processed_msgs:
+        if message_id in self._processed_set:
             return False, "already_processed"
-        
+
+        # Skip if message is from yourself
+        if str(message.user_id) == self._my_id_str:
+            return False, "self_message"
+
         # Skip messages older than 5 minutes
-        message_age = time.time() - message.timestamp.timestamp()
+        message_age = self._cycle_now - message.timestamp.timestamp()
         if message_age > 300:  # 5 minutes
             return False, "too_old"
-        
-        # Skip if message is from yourself
-        if str(message.user_id) == str(self.cl.user_id):
-            return False, "self_message"
-        
-        is_group = self.is_group_chat(thread)
-        text = (message.text or "").lower()
-        
+
         # ALWAYS reply to Creator
         if CREATOR_ID and str(message.user_id) == CREATOR_ID:
             return True, "creator"
-        
+
         # DM Behavior: Always reply
-        if not is_group:
+        if not self.is_group_chat(thread):
             return True, "dm"
-        
+
         # GROUP Behavior: Only reply when asked
-        if is_group:
-            # Check for triggers
-            triggers = self.settings['group']['triggers']
-            for trigger in triggers:
-                if trigger in text:
-                    return True, f"trigger_{trigger}"
-            
-            # Check if someone is asking Emperor
-            if text.endswith('?'):
-                emperor_patterns = [
-                    r'.*emperor.*\?',
-                    r'.*ai.*\?',
-                    r'.*bot.*\?',
-                    r'\?.*emperor.*',
-                ]
-                for pattern in emperor_patterns:
-                    if re.search(pattern, text, re.IGNORECASE):
-                        return True, "question_for_emperor"
-            
-            # Small chance to join conversation naturally
-            if random.random() < self.settings['group']['natural_reply_chance']:
-                # Don't talk too much in groups
-                thread_id = str(thread.id)
-                if thread_id not in self.conversation_history:
-                    self.conversation_history[thread_id] = []
-                
-                # Only reply every 10 messages in group
-                if len(self.conversation_history[thread_id]) % 10 == 0:
-                    return True, "natural_conversation"
-        
+        text = (message.text or "").lower()
+
+        # One pass over the text finds any configured trigger
+        trigger_match = self._trigger_re.search(text)
+        if trigger_match:
+            return True, f"trigger_{trigger_match.group(0)}"
+
+        # Check if someone is asking Emperor
+        if self._question_re.search(text):
+            return True, "question_for_emperor"
+
+        # Small chance to join conversation naturally
+        if random.random() < self.settings['group']['natural_reply_chance']:
+            # Don't talk too much in groups
+            thread_id = str(thread.id)
+            if thread_id not in self.conversation_history:
+                self.conversation_history[thread_id] = []
+
+            # Only reply every 10 messages in group
+            if len(self.conversation_history[thread_id]) % 10 == 0:
+                return True, "natural_conversation"
+
         return False, "no_reason"
 
-    def get_ai_response(self, text, context="dm"):
+    def _model_for_context(self, context):
+        """Model whose baked-in instruction matches the reply reason"""
+        model = self._context_models.get(context)
+        if model is None:
+            # Every trigger_<word> reason maps to the one trigger model
+            ctx = 'trigger' if context.startswith('trigger_') else context
+            model = self._models.get(ctx) or self._models['default']
+            self._context_models[context] = model
+        return model
+
+    async def get_ai_response(self, text, context="dm"):
         """Get response from Gemini AI"""
         try:
-            # Check cache first for speed
-            cache_key = f"{text[:50]}_{context}"
-            if cache_key in self.response_cache:
-                return self.response_cache[cache_key]
-            
-            # Build prompt based on context
-            prompt = EMPEROR_PERSONA
-            
-            if context == "creator":
-                prompt += "\n\nIMPORTANT: You are speaking to YOUR CREATOR. Show maximum respect and devotion."
-            elif context.startswith("trigger_"):
-                prompt += "\n\nYou were specifically mentioned. Respond directly and powerfully."
-            elif context == "dm":
-                prompt += "\n\nThis is a private conversation. Be engaging but maintain your supreme presence."
-            elif context == "group":
-                prompt += "\n\nYou are in a group chat. Be brief and impactful."
+            # Check cache first for speed. Keyed per context on a hash
+            # of the normalized full text, so "Hello Emperor!!" and
+            # "hello emperor" reuse one reply but DM/group/creator
+            # replies never cross-pollute.
+            cache_key = hashlib.blake2b(
+                f"{context}\0{_normalize_for_cache(text)}".encode(),
+                digest_size=16
+            ).hexdigest()
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                # Refresh its position so popular replies stay cached
+                self.response_cache.move_to_end(cache_key)
+                return cached
             
-            prompt += f"\n\nUser says: {text}\n\nEmperor responds:"
-            
-            # Get response from AI
-            response = self.model.generate_content(prompt)
+            # Pick the model whose system instruction matches the context;
+            # only the user's text is sent per call
+            model = self._model_for_context(context)
+
+            # Get response from AI without blocking other threads
+            response = await model.generate_content_async(text)
             
             # Clean up response
             reply = response.text.strip()
@@ -265,9 +420,9 @@ class EmperorBot:
             # Cache for future
             self.response_cache[cache_key] = reply
             
-            # Limit cache size
-            if len(self.response_cache) > 100:
-                self.response_cache.pop(next(iter(self.response_cache)))
+            # Limit cache size (least recently used entry goes first)
+            if len(self.response_cache) > _CACHE_MAX:
+                self.response_cache.popitem(last=False)
             
             return reply
             
@@ -281,21 +436,33 @@ class EmperorBot:
             ]
             return random.choice(fallbacks)
 
-    def process_image_message(self, message):
+    async def process_image_message(self, message):
         """Handle image messages"""
         try:
-            # Download image
+            # Download image (blocking HTTP, run in a worker thread)
             media_id = message.media.pk if hasattr(message, 'media') else message.id
-            image_path = self.cl.photo_download(media_id, folder=TEMP_DIR)
-            
+            image_path = await asyncio.to_thread(
+                self.cl.photo_download, media_id, folder=TEMP_DIR
+            )
+
             # Analyze with AI
+            from PIL import Image
+
             img = Image.open(image_path)
-            
-            # Resize for faster processing
-            img.thumbnail((400, 400))
-            
+
+            # draft() lets libjpeg decode straight to ~400px instead of
+            # decoding the full-resolution photo and shrinking afterwards
+            img.draft('RGB', (400, 400))
+            img.thumbnail((400, 400), Image.Resampling.BILINEAR)
+
+            # Send compressed JPEG bytes, not raw pixels, to cut upload size
+            buf = io.BytesIO()
+            img.convert('RGB').save(buf, 'JPEG', quality=80)
+
             prompt = f"{EMPEROR_PERSONA}\nDescribe this image in one powerful sentence."
-            response = self.model.generate_content([prompt, img])
+            response = await self.model.generate_content_async(
+                [prompt, {'mime_type': 'image/jpeg', 'data': buf.getvalue()}]
+            )
             
             reply = response.text.strip()
             
@@ -309,35 +476,123 @@ class EmperorBot:
             logger.error(f"⚠️ Image Error: {e}")
             return "I perceive the visual data... intriguing."
 
-    def process_message(self, thread, message, reply_reason):
+    async def process_message(self, thread, message, reply_reason):
         """Process and reply to a message"""
         thread_id = thread.id
         message_id = str(message.id)
-        
+
         logger.info(f"📥 New message ({reply_reason}): {message.text[:50] if message.text else '[Image]'}")
-        
-        # Add human-like delay
-        delay = random.uniform(1, 4)
-        time.sleep(delay)
-        
+
+        # Add human-like delay (other threads keep processing meanwhile).
+        # If the message is already 10+ seconds old the reply gap reads
+        # as human on its own, so don't add more on top.
+        message_age = self._cycle_now - message.timestamp.timestamp()
+        if message_age < 10:
+            await asyncio.sleep(random.uniform(1, 4))
+
         reply_text = ""
-        
-        # Handle image messages
-        if message.item_type in ['media_share', 'visual_media']:
-            reply_text = self.process_image_message(message)
-        
-        # Handle text messages
-        elif message.text:
-            reply_text = self.get_ai_response(message.text, reply_reason)
-        
-        # Send reply
+
+        # Dispatch on message type: images first, then text
+        match message.item_type:
+            case item_type if item_type in _IMAGE_ITEMS:
+                reply_text = await self.process_image_message(message)
+            case _ if message.text:
+                reply_text = await self.get_ai_response(message.text, reply_reason)
+
+        # Send reply (blocking HTTP, run in a worker thread)
         if reply_text:
-            self.cl.direct_answer(thread_id, reply_text)
+            await asyncio.to_thread(self.cl.direct_answer, thread_id, reply_text)
             logger.info(f"📤 Replied: {reply_text[:50]}...")
         
         # Mark as processed
-        self.processed_msgs.append(message_id)
-        self.save_processed_messages()
+        self._mark_processed(message_id)
+        self.save_processed_messages(message_id)
+
+    def _is_thread_fresh(self, thread):
+        """True if the thread has activity newer than our watermark"""
+        if self._last_activity_at is None:
+            return True
+        last_at = getattr(thread, 'last_activity_at', None)
+        # Threads without a timestamp are checked the slow way
+        return last_at is None or last_at > self._last_activity_at
+
+    async def _handle_thread(self, thread):
+        """Check one thread and reply if needed"""
+        if not thread.messages:
+            return
+
+        latest_message = thread.messages[0]
+
+        # Decide if we should reply
+        should_reply, reason = self.should_reply_to_message(latest_message, thread)
+
+        if should_reply:
+            # Semaphore keeps us from hammering Instagram/Gemini at once
+            async with self._reply_semaphore:
+                await self.process_message(thread, latest_message, reason)
+            return True
+
+        return False
+
+    async def _main_loop(self):
+        """Poll Instagram and handle all threads concurrently"""
+        self._reply_semaphore = asyncio.Semaphore(4)
+        error_count = 0
+        idle_cycles = 0
+
+        while True:
+            try:
+                # Get recent conversations (blocking HTTP, worker thread)
+                threads = await asyncio.to_thread(self.cl.direct_threads, amount=10)
+
+                # Sample the clock once for this cycle's age checks
+                self._cycle_now = time.time()
+
+                # Only look at threads that moved since the last cycle
+                fresh = [
+                    t for t in threads
+                    if self._is_thread_fresh(t)
+                ]
+
+                # Handle every fresh thread concurrently: AI calls for
+                # one thread overlap with Instagram I/O for the others
+                replied = await asyncio.gather(*(self._handle_thread(t) for t in fresh))
+
+                # Advance the watermark past everything we just saw
+                seen_times = [
+                    t.last_activity_at for t in threads
+                    if getattr(t, 'last_activity_at', None)
+                ]
+                if seen_times:
+                    self._last_activity_at = max(seen_times)
+
+                # Reset error count on success
+                error_count = 0
+
+                # Shrink the processed log if it has grown too long
+                self.compact_processed_file()
+
+                # Wait before checking again: quick re-poll while the
+                # chat is active, back off up to 2 minutes when idle
+                if any(replied):
+                    idle_cycles = 0
+                else:
+                    # The sleep saturates at 6 cycles; clamp so the
+                    # exponent can't overflow on a long-idle inbox
+                    idle_cycles = min(idle_cycles + 1, 6)
+                sleep_time = min(120, 15 * 1.5 ** idle_cycles)
+                await asyncio.sleep(sleep_time)
+
+            except Exception as e:
+                error_count += 1
+                logger.error(f"⚠️ Error in main loop: {e}")
+
+                # If too many errors, sleep longer
+                if error_count > 5:
+                    logger.error("⚠️ Too many errors, sleeping for 5 minutes...")
+                    await asyncio.sleep(300)
+                else:
+                    await asyncio.sleep(60)
 
     def run(self):
         """Main bot loop"""
@@ -362,47 +617,11 @@ class EmperorBot:
         
         logger.info("🚀 Emperor is now active and listening...")
         print("\n✅ Bot is running! Press Ctrl+C to stop.\n")
-        
-        error_count = 0
-        
-        while True:
-            try:
-                # Get recent conversations
-                threads = self.cl.direct_threads(amount=10)
-                
-                for thread in threads:
-                    if not thread.messages:
-                        continue
-                    
-                    latest_message = thread.messages[0]
-                    
-                    # Decide if we should reply
-                    should_reply, reason = self.should_reply_to_message(latest_message, thread)
-                    
-                    if should_reply:
-                        self.process_message(thread, latest_message, reason)
-                
-                # Reset error count on success
-                error_count = 0
-                
-                # Wait before checking again
-                sleep_time = random.randint(15, 30)
-                time.sleep(sleep_time)
-                
-            except KeyboardInterrupt:
-                logger.info("👑 Emperor is going to sleep...")
-                break
-                
-            except Exception as e:
-                error_count += 1
-                logger.error(f"⚠️ Error in main loop: {e}")
-                
-                # If too many errors, sleep longer
-                if error_count > 5:
-                    logger.error("⚠️ Too many errors, sleeping for 5 minutes...")
-                    time.sleep(300)
-                else:
-                    time.sleep(60)
+
+        try:
+            asyncio.run(self._main_loop())
+        except KeyboardInterrupt:
+            logger.info("👑 Emperor is going to sleep...")
 
 # ==========================================
 # 🚀 START THE BOT